@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+备份热路径上的纯计算函数
+
+每次备份需要对每个文件执行这些函数，文件数量很大时解释器开销不可忽略。
+本模块只使用带完整类型注解的纯Python代码，不依赖 paramiko，
+可以直接作为普通模块导入，也可以用 mypyc 编译为C扩展：
+
+    pip install mypy
+    mypyc backup_core.py
+"""
+
+import os
+import posixpath
+from typing import Dict, List, Set, Tuple
+
+
+def unescape_checksum_path(path: str) -> str:
+    """还原 md5sum/sha256sum/b3sum 输出中被转义的文件名"""
+    result: List[str] = []
+    chars = iter(path)
+    for ch in chars:
+        if ch == '\\':
+            ch = next(chars, '')
+            result.append('\n' if ch == 'n' else ch)
+        else:
+            result.append(ch)
+    return ''.join(result)
+
+
+def parse_checksum_output(output: str) -> Dict[str, str]:
+    """解析校验命令的输出，返回 {路径: 哈希值}"""
+    hashes: Dict[str, str] = {}
+    for line in output.split('\n'):
+        if not line:
+            continue
+        # 文件名包含反斜杠或换行时，输出会在行首加 "\" 并转义
+        escaped = line.startswith('\\')
+        if escaped:
+            line = line[1:]
+        file_hash, _, file_path = line.partition(' ')
+        # 哈希与路径之间为 "  "（文本模式）或 " *"（二进制模式）
+        file_path = file_path[1:]
+        if escaped:
+            file_path = unescape_checksum_path(file_path)
+        if file_hash and file_path:
+            hashes[file_path] = file_hash
+    return hashes
+
+
+def parse_find_output(output: str) -> Dict[str, Tuple[int, int]]:
+    """解析 find -printf '%s\\t%T@\\t%p\\0' 的输出，返回 {路径: (大小, 修改时间)}"""
+    files: Dict[str, Tuple[int, int]] = {}
+    for record in output.split('\0'):
+        parts = record.split('\t', 2)
+        if len(parts) != 3:
+            continue
+        # %T@ 带小数部分，截断为整数秒，与SFTP返回的修改时间一致
+        files[parts[2]] = (int(parts[0]), int(parts[1].split('.')[0]))
+    return files
+
+
+def select_hash_candidates(remote_stats: Dict[str, Tuple[int, int]],
+                           file_stats: Dict[str, Tuple[int, int]],
+                           trust_mtime: bool) -> List[str]:
+    """筛选大小或修改时间与索引不一致、需要重新计算哈希的文件"""
+    if not trust_mtime:
+        return list(remote_stats)
+    return [file_path for file_path, stats in remote_stats.items() if file_stats.get(file_path) != stats]
+
+
+def select_changed_files(file_paths: List[str], remote_hashes: Dict[str, str],
+                         hash_index: Dict[str, str]) -> Tuple[List[str], List[str]]:
+    """按哈希比较文件，返回 (需要下载的文件, 内容未变的文件)"""
+    changed: List[str] = []
+    unchanged: List[str] = []
+    for file_path in file_paths:
+        remote_hash = remote_hashes.get(file_path, "")
+        # 没有取到远程哈希的文件一律重新下载
+        if remote_hash and remote_hash == hash_index.get(file_path, ""):
+            unchanged.append(file_path)
+        else:
+            changed.append(file_path)
+    return changed, unchanged
+
+
+def plan_downloads(remote_path: str, local_path: str,
+                   file_paths: List[str]) -> Tuple[List[Tuple[str, str]], List[str]]:
+    """计算每个远程文件的本地路径，返回 (下载任务, 需要创建的本地目录)"""
+    tasks: List[Tuple[str, str]] = []
+    local_dirs: Set[str] = set()
+    for file_path in file_paths:
+        rel_path = posixpath.relpath(file_path, remote_path)
+        local_file = os.path.join(local_path, *rel_path.split('/'))
+        tasks.append((file_path, local_file))
+        local_dirs.add(os.path.dirname(local_file))
+    return tasks, sorted(local_dirs)
@@ -12,18 +12,175 @@ import logging
 import shutil
 import threading
 import hashlib
+import shlex
+import posixpath
+import sqlite3
+import stat
+import unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, fields
 from datetime import datetime
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 import argparse
 
 try:
     import paramiko
-    from scp import SCPClient
 except ImportError:
-    print("请安装依赖: pip install paramiko scp")
+    print("请安装依赖: pip install paramiko")
     sys.exit(1)
 
+from backup_core import (
+    parse_checksum_output,
+    parse_find_output,
+    plan_downloads,
+    select_changed_files,
+    select_hash_candidates,
+)
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# 支持的哈希算法及对应的远程命令，按优先级排列
+HASH_ALGORITHMS = (
+    ('blake3', 'b3sum'),
+    ('sha256', 'sha256sum'),
+    ('md5', 'md5sum'),
+)
+
+# 计算本地文件哈希时每次读取的字节数
+HASH_BLOCK_SIZE = 1 << 20
+
+# 每个线程复用一块读取缓冲区；每个文件都新建 1MB 缓冲区的清零开销在小文件较多时比读取本身还大
+_hash_buffers = threading.local()
+
+# 优先协商的SSH加密算法：AEAD模式由 cryptography/OpenSSL 使用 AES-NI 硬件加速
+PREFERRED_CIPHERS = (
+    'aes128-gcm@openssh.com',
+    'aes256-gcm@openssh.com',
+    'chacha20-poly1305@openssh.com',
+)
+
+# SSH保活间隔（秒），防止长时间计算哈希时连接被防火墙断开
+SSH_KEEPALIVE_INTERVAL = 30
+
+
+def new_hasher(algorithm: str):
+    """创建指定算法的哈希对象"""
+    if algorithm == 'blake3':
+        return blake3.blake3()
+    return hashlib.new(algorithm)
+
+
+def create_transport(sock, **kwargs):
+    """创建SSH传输层，在密钥协商前调整加密算法的优先级"""
+    transport = paramiko.Transport(sock, **kwargs)
+    options = transport.get_security_options()
+    # 只保留当前 paramiko 版本支持的算法，其余算法按原顺序排在后面
+    preferred = tuple(cipher for cipher in PREFERRED_CIPHERS if cipher in options.ciphers)
+    options.ciphers = preferred + tuple(cipher for cipher in options.ciphers if cipher not in preferred)
+    return transport
+
+
+def is_valid_utf8(text: str) -> bool:
+    """判断以 surrogateescape 解码的字符串原本是否为合法的UTF-8"""
+    try:
+        text.encode('utf-8')
+        return True
+    except UnicodeEncodeError:
+        return False
+
+
+def iter_local_files(root: str):
+    """遍历本地目录下的所有文件路径"""
+    # os.scandir 直接使用目录项中的文件类型，无需逐个 stat
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    yield entry.path
+
+
+def copy_file_fast(src: str, dst: str):
+    """在内核中复制文件内容，避免用户态缓冲区拷贝"""
+    # copy_file_range 在 XFS/btrfs 等文件系统上可以直接共享数据块（reflink）
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            shutil.copystat(src, dst)
+            return
+        except OSError:
+            # 跨文件系统（EXDEV）或内核不支持时，交给 shutil 使用 sendfile 复制
+            pass
+    shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+
+def hardlink_tree(src: Path, dst: Path):
+    """以硬链接方式复制目录树，不支持硬链接时（如跨文件系统）退回到复制文件"""
+    use_links = True
+    stack = [(str(src), str(dst))]
+    while stack:
+        src_dir, dst_dir = stack.pop()
+        os.makedirs(dst_dir, exist_ok=True)
+        with os.scandir(src_dir) as entries:
+            for entry in entries:
+                target = os.path.join(dst_dir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, target))
+                    continue
+                if use_links and not entry.is_symlink():
+                    try:
+                        os.link(entry.path, target)
+                        continue
+                    except OSError:
+                        use_links = False
+                if entry.is_symlink():
+                    shutil.copy2(entry.path, target, follow_symlinks=False)
+                else:
+                    copy_file_fast(entry.path, target)
+
+
+@dataclass(frozen=True)
+class BackupSettings:
+    """备份设置（backup_settings 配置项）"""
+    local_backup_dir: str = "./backups"
+    max_backup_versions: int = 7
+    compression: bool = True
+    encryption: bool = False
+    log_level: str = "INFO"
+    show_detailed_progress: bool = True
+    show_current_file: bool = True
+    max_concurrent_transfers: int = 8
+    max_parallel_servers: int = 4
+    trust_mtime: bool = True
+    delta_min_size: int = 16 << 20
+    delta_block_size: int = 4 << 20
+    
+    @classmethod
+    def from_dict(cls, data: Dict) -> "BackupSettings":
+        """从配置字典创建，忽略未知的配置项"""
+        known = {f.name for f in fields(cls)}
+        return cls(**{key: value for key, value in data.items() if key in known})
+
 
 class BackupConfig:
     """备份配置类"""
@@ -31,110 +188,367 @@ class BackupConfig:
     def __init__(self, config_file: str = "backup_config.json"):
         self.config_file = config_file
         self.config = self.load_config()
+        # 解析一次，后续直接读取属性
+        self.settings = BackupSettings.from_dict(self.config.get('backup_settings', {}))
     
     def load_config(self) -> Dict:
         """加载配置文件"""
         if not os.path.exists(self.config_file):
-            print(f"配置文件不存在: {self.config_file}")
+            console.print(f"配置文件不存在: {self.config_file}")
             sys.exit(1)
         
         try:
             with open(self.config_file, 'r', encoding='utf-8') as f:
                 return json.load(f)
         except Exception as e:
-            print(f"配置文件加载失败: {e}")
+            console.print(f"配置文件加载失败: {e}")
             sys.exit(1)
 
 
 class IncrementalBackup:
     """增量备份管理类"""
     
+    # 索引数据库结构版本，记录在 PRAGMA user_version 中
+    SCHEMA_VERSION = 2
+    
     def __init__(self, server_name: str, backup_dir: Path):
         self.server_name = server_name
         self.backup_dir = backup_dir
         self.hash_index_dir = backup_dir / "hash_index"
         self.hash_index_dir.mkdir(exist_ok=True)
+        # 旧版JSON索引，仅在首次创建数据库时导入
         self.hash_index_file = self.hash_index_dir / f"{server_name}_hash.json"
+        self.hash_index_db = self.hash_index_dir / f"{server_name}_hash.db"
+        self.hash_algorithm = 'md5'
+        self.hash_command = 'md5sum'
+        self.index_algorithm = 'md5'
+        # 自上次保存以来变化的条目，保存时只写入这些
+        self._dirty_paths = set()
+        self._index_cleared = False
+        # 哈希算法变化后，需要先用新算法重新计算本地已备份文件的哈希
+        self.rehash_pending = False
+        self.db = None
+        # 建立索引时远程文件的 (大小, 修改时间)，用于跳过未变化文件的哈希计算
+        self.file_stats: Dict[str, Tuple[int, int]] = {}
         self.hash_index = self.load_hash_index()
     
     def load_hash_index(self) -> Dict[str, str]:
-        """加载哈希索引文件"""
+        """加载哈希索引数据库"""
+        try:
+            self.db = sqlite3.connect(str(self.hash_index_db))
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            
+            schema_version = self.db.execute("PRAGMA user_version").fetchone()[0]
+            if schema_version == 0:
+                self.create_index_schema()
+            elif schema_version < self.SCHEMA_VERSION:
+                self.upgrade_index_schema(schema_version)
+            
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'algorithm'").fetchone()
+            if row:
+                self.index_algorithm = row[0]
+            
+            hash_index = {}
+            for path, file_hash, size, mtime in self.db.execute("SELECT path, hash, size, mtime FROM hashes"):
+                hash_index[path] = file_hash
+                if size is not None and mtime is not None:
+                    self.file_stats[path] = (size, mtime)
+            return hash_index
+        except Exception as e:
+            console.print(f"加载哈希索引失败: {e}")
+            return {}
+    
+    def create_index_schema(self):
+        """创建索引表，并导入旧版JSON索引"""
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS hashes "
+                "(path TEXT PRIMARY KEY, hash TEXT NOT NULL, size INTEGER, mtime INTEGER)"
+            )
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            
+            legacy_index = self.load_legacy_index()
+            if legacy_index:
+                self.db.executemany("INSERT OR REPLACE INTO hashes (path, hash) VALUES (?, ?)", legacy_index.items())
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('algorithm', ?)", (self.index_algorithm,))
+                console.print(f"已导入旧版哈希索引: {len(legacy_index)} 个文件")
+            self.db.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+    
+    def upgrade_index_schema(self, schema_version: int):
+        """升级旧版本的索引表结构"""
+        with self.db:
+            if schema_version < 2:
+                # 版本2增加文件大小和修改时间
+                self.db.execute("ALTER TABLE hashes ADD COLUMN size INTEGER")
+                self.db.execute("ALTER TABLE hashes ADD COLUMN mtime INTEGER")
+            self.db.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+    
+    def load_legacy_index(self) -> Dict[str, str]:
+        """读取旧版JSON哈希索引"""
         if not self.hash_index_file.exists():
             return {}
         
         try:
-            with open(self.hash_index_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with open(self.hash_index_file, 'rb') as f:
+                raw = f.read()
+            # 旧索引可能有几十MB，优先使用更快的 orjson 解析
+            data = orjson.loads(raw) if orjson else json.loads(raw.decode('utf-8'))
+            # 最早的索引直接是 {路径: MD5}，之后的版本记录了哈希算法
+            if 'algorithm' in data and 'hashes' in data:
+                self.index_algorithm = data['algorithm']
+                return data['hashes']
+            return data
         except Exception as e:
-            print(f"加载哈希索引失败: {e}")
+            console.print(f"读取旧版哈希索引失败: {e}")
             return {}
     
     def save_hash_index(self):
-        """保存哈希索引文件"""
+        """保存哈希索引，只写入有变化的条目"""
+        if self.db is None:
+            return
+        
         try:
-            with open(self.hash_index_file, 'w', encoding='utf-8') as f:
-                json.dump(self.hash_index, f, indent=2, ensure_ascii=False)
+            with self.db:
+                if self._index_cleared:
+                    self.db.execute("DELETE FROM hashes")
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)",
+                    ((path, self.hash_index[path]) + self.file_stats.get(path, (None, None))
+                     for path in self._dirty_paths)
+                )
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('algorithm', ?)", (self.hash_algorithm,))
+            self._dirty_paths.clear()
+            self._index_cleared = False
         except Exception as e:
-            print(f"保存哈希索引失败: {e}")
+            console.print(f"保存哈希索引失败: {e}")
+    
+    def close(self):
+        """关闭索引数据库"""
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+    
+    def set_file_hash(self, remote_path: str, file_hash: str,
+                      size: Optional[int] = None, mtime: Optional[int] = None):
+        """记录文件哈希及远程文件状态，待保存时写入数据库"""
+        self.hash_index[remote_path] = file_hash
+        if size is not None and mtime is not None:
+            self.file_stats[remote_path] = (size, mtime)
+        else:
+            self.file_stats.pop(remote_path, None)
+        self._dirty_paths.add(remote_path)
+    
+    def set_hash_algorithm(self, algorithm: str):
+        """设置哈希算法，与索引记录的算法不一致时重建索引"""
+        self.hash_algorithm = algorithm
+        self.hash_command = dict(HASH_ALGORITHMS)[algorithm]
+        if self.hash_index and self.index_algorithm != algorithm:
+            # 本地已有完整备份，只需在本地重新计算哈希，不必重新下载所有文件
+            console.print(f"哈希算法由 {self.index_algorithm} 变更为 {algorithm}，将用新算法重新计算本地备份的哈希")
+            self.hash_index = {}
+            self.file_stats = {}
+            self._dirty_paths.clear()
+            self._index_cleared = True
+            self.rehash_pending = True
+        self.index_algorithm = algorithm
     
     def calculate_file_hash(self, file_path: str) -> str:
-        """计算文件MD5哈希值"""
+        """计算文件哈希值"""
         try:
-            hash_md5 = hashlib.md5()
-            with open(file_path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_md5.update(chunk)
-            return hash_md5.hexdigest()
+            hasher = new_hasher(self.hash_algorithm)
+            # 复用当前线程的缓冲区读取，避免每次读取都分配新的 bytes 对象
+            view = getattr(_hash_buffers, 'view', None)
+            if view is None:
+                view = _hash_buffers.view = memoryview(bytearray(HASH_BLOCK_SIZE))
+            # 关闭Python层的缓冲以免多一次内存拷贝
+            with open(file_path, "rb", buffering=0) as f:
+                while True:
+                    size = f.readinto(view)
+                    if not size:
+                        break
+                    hasher.update(view[:size])
+            return hasher.hexdigest()
         except Exception as e:
-            print(f"计算文件哈希失败 {file_path}: {e}")
+            console.print(f"计算文件哈希失败 {file_path}: {e}")
             return ""
     
-    def get_remote_file_hash(self, remote_path: str, ssh_client) -> str:
-        """获取远程文件哈希值"""
-        try:
-            stdin, stdout, stderr = ssh_client.exec_command(f'md5sum "{remote_path}"')
-            result = stdout.read().decode('utf-8').strip()
-            if result:
-                return result.split()[0]
-        except:
-            pass
-        return ""
-    
-    def get_remote_file_list(self, remote_path: str, ssh_client) -> list:
-        """获取远程文件列表"""
-        try:
-            stdin, stdout, stderr = ssh_client.exec_command(f'find "{remote_path}" -type f')
-            files = stdout.read().decode('utf-8').strip().split('\n')
-            return [f for f in files if f.strip()]
-        except:
-            return []
-    
-    def should_backup_file(self, remote_path: str, ssh_client) -> bool:
-        """判断文件是否需要备份"""
-        # 获取远程文件哈希
-        remote_hash = self.get_remote_file_hash(remote_path, ssh_client)
-        if not remote_hash:
-            return True  # 如果无法获取哈希，则备份
-        
-        # 获取之前的哈希
-        previous_hash = self.hash_index.get(remote_path, "")
+    def fetch_remote_hashes(self, file_paths: List[str], ssh_client) -> Dict[str, str]:
+        """批量获取指定远程文件的哈希值（一次SSH调用）"""
+        if not file_paths:
+            return {}
         
-        # 如果哈希不同，则需要备份
-        if remote_hash != previous_hash:
-            self.hash_index[remote_path] = remote_hash
-            return True
+        command = f'xargs -0 -n 64 {self.hash_command} 2>/dev/null'
+        try:
+            stdin, stdout, stderr = ssh_client.exec_command(command)
+            
+            # 文件列表通过标准输入传给 xargs；在单独线程中写入，
+            # 避免输出填满SSH窗口后双方互相等待
+            def write_paths():
+                try:
+                    stdin.write('\0'.join(file_paths) + '\0')
+                    stdin.channel.shutdown_write()
+                except Exception:
+                    pass
+            
+            writer = threading.Thread(target=write_paths, daemon=True)
+            writer.start()
+            output = stdout.read().decode('utf-8', errors='replace')
+            writer.join()
+        except Exception as e:
+            console.print(f"批量获取远程文件哈希失败: {e}")
+            return {}
         
-        return False
+        return parse_checksum_output(output)
     
     def is_first_backup(self) -> bool:
         """判断是否是第一次备份"""
-        return len(self.hash_index) == 0
+        return len(self.hash_index) == 0 and not self.rehash_pending
+
+
+# 字节单位
+_KB = 1 << 10
+_MB = 1 << 20
+_GB = 1 << 30
+
+
+def _format_time(seconds):
+    """格式化剩余时间"""
+    if seconds < 60:
+        return f"{seconds:.0f}秒"
+    elif seconds < 3600:
+        return f"{seconds/60:.0f}分{seconds%60:.0f}秒"
+    else:
+        return f"{seconds/3600:.0f}小时{(seconds%3600)/60:.0f}分"
+
+
+def _format_size(bytes_size):
+    """格式化文件大小"""
+    if bytes_size < _KB:
+        return f"{bytes_size:.0f}B"
+    elif bytes_size < _MB:
+        return f"{bytes_size/_KB:.1f}KB"
+    elif bytes_size < _GB:
+        return f"{bytes_size/_MB:.1f}MB"
+    else:
+        return f"{bytes_size/_GB:.1f}GB"
+
+
+def _format_speed(bytes_per_sec):
+    """格式化传输速度"""
+    return f"{_format_size(bytes_per_sec)}/s"
+
+
+def _display_width(text):
+    """计算文本在终端中占用的列数（中文等全角字符占两列）"""
+    return sum(2 if unicodedata.east_asian_width(ch) in 'WF' else 1 for ch in text)
+
+
+def _truncate_display(text, max_width):
+    """按终端列数截断文本"""
+    width = 0
+    for i, ch in enumerate(text):
+        width += 2 if unicodedata.east_asian_width(ch) in 'WF' else 1
+        if width > max_width:
+            return text[:i]
+    return text
+
+
+class ConsolePrinter:
+    """控制台输出类
+    
+    多个服务器并行备份时，所有输出都经由同一个对象写到终端：普通输出整段写出，
+    各进度条合并显示在终端最后一行，写普通输出前先擦除、写完后重绘，互不覆盖。
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 进度条 -> (完整文本, 简短文本)，按开始顺序显示
+        self._statuses = {}
+        self._status_width = 0
+        # 每个线程可以设置行前缀，用于区分并行备份的服务器
+        self._local = threading.local()
+        self.is_tty = sys.stdout.isatty()
+    
+    def line_prefix(self) -> str:
+        return getattr(self._local, 'prefix', '')
+    
+    def set_line_prefix(self, prefix: str):
+        """设置当前线程输出的行前缀"""
+        self._local.prefix = prefix
+    
+    def print(self, *args, sep=' ', end='\n'):
+        """代替内置 print，每行加上当前线程的前缀"""
+        text = sep.join(str(arg) for arg in args) + end
+        prefix = self.line_prefix()
+        if prefix:
+            text = ''.join(prefix + line if line.strip() else line for line in text.splitlines(True))
+        self.write(text)
+    
+    def write(self, text, stream=None):
+        """写出一段文本，不会与进度行混在一起"""
+        with self._lock:
+            self._clear_status()
+            stream = stream or sys.stdout
+            stream.write(text)
+            stream.flush()
+            self._draw_status()
+    
+    def set_status(self, key, text, short_text):
+        """更新进度行；同时有多个进度条时显示各自的简短文本"""
+        with self._lock:
+            self._statuses[key] = (text, short_text)
+            self._draw_status()
+    
+    def remove_status(self, key):
+        """进度条结束后从进度行中移除"""
+        with self._lock:
+            if self._statuses.pop(key, None) is not None:
+                self._clear_status()
+                self._draw_status()
+    
+    def _clear_status(self):
+        if self._status_width:
+            sys.stdout.write('\r' + ' ' * self._status_width + '\r')
+            sys.stdout.flush()
+            self._status_width = 0
+    
+    def _draw_status(self):
+        if not self._statuses or not self.is_tty:
+            return
+        if len(self._statuses) == 1:
+            line = next(iter(self._statuses.values()))[0]
+        else:
+            line = ' | '.join(short_text for _, short_text in self._statuses.values())
+        # 超过终端宽度会自动换行，\r 就只能回到最后一行，因此截断到一行以内
+        line = _truncate_display(line, shutil.get_terminal_size().columns - 1)
+        width = _display_width(line)
+        sys.stdout.write('\r' + line + ' ' * max(0, self._status_width - width))
+        sys.stdout.flush()
+        self._status_width = width
+
+
+class ConsoleStream:
+    """经由 console 写出的类文件对象，供日志的控制台处理器使用"""
+    
+    def __init__(self, stream):
+        self.stream = stream
+    
+    def write(self, text):
+        console.write(text, self.stream)
+    
+    def flush(self):
+        pass
+
+
+# 全局唯一的控制台输出对象
+console = ConsolePrinter()
 
 
 class ProgressBar:
     """进度条显示类"""
     
-    def __init__(self, total, description="进度", show_file_info=False):
+    def __init__(self, total, description="进度", show_file_info=False, total_size=0):
         self.total = total
         self.current = 0
         self.description = description
@@ -142,25 +556,49 @@ class ProgressBar:
         self.last_update = 0
         self.show_file_info = show_file_info
         self.current_file = ""
-        self.total_size = 0
+        self.total_size = total_size
         self.transferred_size = 0
         self.last_size_update = 0
+        self.last_printed_current = 0
+        # 文件数变化达到总数的千分之一才需要重绘
+        self.current_step = max(1, total // 1000)
+        # 非终端输出（如定时任务重定向到文件）时不绘制进度条
+        self.is_tty = sys.stdout.isatty()
+        # 传输回调可能来自多个下载线程
+        self._lock = threading.Lock()
         
     def update(self, current, current_file="", file_size=0):
         """更新进度"""
+        with self._lock:
+            self._update(current, current_file, file_size)
+    
+    def add_transferred(self, nbytes, current_file=""):
+        """累计已传输字节数，不改变文件进度"""
+        with self._lock:
+            self._update(self.current, current_file, nbytes)
+    
+    def _update(self, current, current_file, file_size):
         self.current = current
         if current_file:
             self.current_file = current_file
         if file_size > 0:
             self.transferred_size += file_size
+        
+        if not self.is_tty:
+            return
             
         now = time.time()
         
-        # 限制更新频率，避免刷屏
+        # 限制更新频率，避免刷屏；显示内容没有变化时也不重绘
         if now - self.last_update < 0.1:
             return
+        if (current - self.last_printed_current < self.current_step
+                and self.transferred_size == self.last_size_update):
+            return
             
         self.last_update = now
+        self.last_printed_current = current
+        self.last_size_update = self.transferred_size
         
         # 计算进度百分比
         percent = (current / self.total) * 100 if self.total > 0 else 0
@@ -172,56 +610,31 @@ class ProgressBar:
         # 计算数据传输速度
         data_speed = self.transferred_size / elapsed if elapsed > 0 else 0
         
-        # 计算剩余时间
-        remaining = (self.total - current) / speed if speed > 0 else 0
+        # 计算剩余时间（已知总大小时按字节估算更准确）
+        if self.total_size > 0:
+            remaining = (self.total_size - self.transferred_size) / data_speed if data_speed > 0 else 0
+        else:
+            remaining = (self.total - current) / speed if speed > 0 else 0
         
         # 创建进度条
         bar_length = 30
         filled_length = int(bar_length * current // self.total) if self.total > 0 else 0
         bar = '█' * filled_length + '░' * (bar_length - filled_length)
         
-        # 格式化时间
-        def format_time(seconds):
-            if seconds < 60:
-                return f"{seconds:.0f}秒"
-            elif seconds < 3600:
-                return f"{seconds/60:.0f}分{seconds%60:.0f}秒"
-            else:
-                return f"{seconds/3600:.0f}小时{(seconds%3600)/60:.0f}分"
-        
-        # 格式化文件大小
-        def format_size(bytes_size):
-            if bytes_size < 1024:
-                return f"{bytes_size:.0f}B"
-            elif bytes_size < 1024*1024:
-                return f"{bytes_size/1024:.1f}KB"
-            elif bytes_size < 1024*1024*1024:
-                return f"{bytes_size/(1024*1024):.1f}MB"
-            else:
-                return f"{bytes_size/(1024*1024*1024):.1f}GB"
-        
-        # 格式化速度
-        def format_speed(bytes_per_sec):
-            if bytes_per_sec < 1024:
-                return f"{bytes_per_sec:.0f}B/s"
-            elif bytes_per_sec < 1024*1024:
-                return f"{bytes_per_sec/1024:.1f}KB/s"
-            elif bytes_per_sec < 1024*1024*1024:
-                return f"{bytes_per_sec/(1024*1024):.1f}MB/s"
-            else:
-                return f"{bytes_per_sec/(1024*1024*1024):.1f}GB/s"
-        
         # 构建显示信息
         info_parts = [
             f"{self.description}: |{bar}| {percent:.1f}% ({current}/{self.total})",
             f"速度: {speed:.1f}文件/秒",
-            f"剩余: {format_time(remaining)}"
+            f"剩余: {_format_time(remaining)}"
         ]
         
         # 添加数据传输信息
         if self.transferred_size > 0:
-            info_parts.append(f"已传输: {format_size(self.transferred_size)}")
-            info_parts.append(f"传输速度: {format_speed(data_speed)}")
+            if self.total_size > 0:
+                info_parts.append(f"已传输: {_format_size(self.transferred_size)}/{_format_size(self.total_size)}")
+            else:
+                info_parts.append(f"已传输: {_format_size(self.transferred_size)}")
+            info_parts.append(f"传输速度: {_format_speed(data_speed)}")
         
         # 添加当前文件信息（如果启用）
         if self.show_file_info and self.current_file:
@@ -231,8 +644,11 @@ class ProgressBar:
                 display_file = "..." + display_file[-47:]
             info_parts.append(f"当前: {display_file}")
         
-        # 显示进度条
-        print(f"\r{' '.join(info_parts)}", end='', flush=True)
+        # 显示进度条；与其他服务器的进度条同时显示时只显示百分比和传输速度
+        short_text = f"{self.description}: {percent:.1f}%"
+        if self.transferred_size > 0:
+            short_text += f" {_format_speed(data_speed)}"
+        console.set_status(self, ' '.join(info_parts), short_text)
     
     def finish(self):
         """完成进度条"""
@@ -240,27 +656,6 @@ class ProgressBar:
         speed = self.total / elapsed if elapsed > 0 else 0
         data_speed = self.transferred_size / elapsed if elapsed > 0 else 0
         
-        # 格式化函数
-        def format_size(bytes_size):
-            if bytes_size < 1024:
-                return f"{bytes_size:.0f}B"
-            elif bytes_size < 1024*1024:
-                return f"{bytes_size/1024:.1f}KB"
-            elif bytes_size < 1024*1024*1024:
-                return f"{bytes_size/(1024*1024):.1f}MB"
-            else:
-                return f"{bytes_size/(1024*1024*1024):.1f}GB"
-        
-        def format_speed(bytes_per_sec):
-            if bytes_per_sec < 1024:
-                return f"{bytes_per_sec:.0f}B/s"
-            elif bytes_per_sec < 1024*1024:
-                return f"{bytes_per_sec/1024:.1f}KB/s"
-            elif bytes_per_sec < 1024*1024*1024:
-                return f"{bytes_per_sec/(1024*1024):.1f}MB/s"
-            else:
-                return f"{bytes_per_sec/(1024*1024*1024):.1f}GB/s"
-        
         # 构建完成信息
         finish_info = [
             f"{self.description}: 完成!",
@@ -269,11 +664,12 @@ class ProgressBar:
         ]
         
         if self.transferred_size > 0:
-            finish_info.append(f"总传输: {format_size(self.transferred_size)}")
-            finish_info.append(f"平均传输速度: {format_speed(data_speed)}")
+            finish_info.append(f"总传输: {_format_size(self.transferred_size)}")
+            finish_info.append(f"平均传输速度: {_format_speed(data_speed)}")
         
-        print(f"\r{' '.join(finish_info)}")
-        print()
+        console.remove_status(self)
+        console.print(' '.join(finish_info))
+        console.print()
 
 
 class BackupLogger:
@@ -288,6 +684,8 @@ class BackupLogger:
         self.logger = logging.getLogger('BackupScript')
         self.logger.setLevel(logging.INFO)
         self.logger.handlers.clear()
+        # 已有自己的文件和控制台处理器，不再传给根日志记录器，否则调度器配置根日志后每条日志会输出两次
+        self.logger.propagate = False
         
         # 文件处理器
         log_file = self.log_dir / f"backup_{datetime.now().strftime('%Y%m%d')}.log"
@@ -296,7 +694,7 @@ class BackupLogger:
         file_handler.setFormatter(logging.Formatter(log_format))
         
         # 控制台处理器
-        console_handler = logging.StreamHandler()
+        console_handler = logging.StreamHandler(ConsoleStream(sys.stderr))
         console_handler.setLevel(logging.INFO)
         console_handler.setFormatter(logging.Formatter(log_format))
         
@@ -308,20 +706,24 @@ class BackupLogger:
 
 
 class SSHBackup:
-    """SSH/SCP备份类"""
+    """SSH/SFTP备份类"""
     
-    def __init__(self, server_config: Dict, logger, incremental_backup, backup_settings=None):
+    def __init__(self, server_config: Dict, logger, incremental_backup, settings: BackupSettings = None):
         self.config = server_config
         self.logger = logger
         self.ssh_client = None
-        self.scp_client = None
         self.total_files = 0
         self.copied_files = 0
+        self._remote_stats = {}
         self.progress_bar = None
-        self.monitor_thread = None
-        self.is_downloading = False
         self.incremental_backup = incremental_backup
-        self.backup_settings = backup_settings or {}
+        self.settings = settings or BackupSettings()
+        # 每个下载线程独占一个SFTP通道，共享同一条SSH连接
+        self._sftp_local = threading.local()
+        self._sftp_clients = []
+        self._sftp_lock = threading.Lock()
+        # 主线程用于遍历远程目录的SFTP通道
+        self.sftp_client = None
     
     def connect(self) -> bool:
         """建立SSH连接"""
@@ -334,62 +736,241 @@ class SSHBackup:
                 port=self.config.get('port', 22),
                 username=self.config['username'],
                 password=self.config['password'],
-                timeout=30
+                timeout=30,
+                transport_factory=create_transport
             )
+            self.ssh_client.get_transport().set_keepalive(SSH_KEEPALIVE_INTERVAL)
             
-            self.scp_client = SCPClient(self.ssh_client.get_transport())
+            self.sftp_client = self.ssh_client.open_sftp()
             self.logger.info(f"SSH连接成功: {self.config['host']}")
+            
+            hash_algorithm = self.detect_hash_algorithm()
+            self.incremental_backup.set_hash_algorithm(hash_algorithm)
+            self.logger.info(f"文件哈希算法: {hash_algorithm}")
             return True
             
         except Exception as e:
             self.logger.error(f"SSH连接失败: {e}")
             return False
     
+    def detect_hash_algorithm(self) -> str:
+        """探测远程可用的哈希命令，选择本地也支持的最快算法"""
+        commands = ' '.join(command for _, command in HASH_ALGORITHMS)
+        probe = f'for c in {commands}; do command -v "$c" >/dev/null 2>&1 && echo "$c"; done'
+        try:
+            stdin, stdout, stderr = self.ssh_client.exec_command(probe)
+            available = set(stdout.read().decode('utf-8').split())
+        except Exception:
+            available = set()
+        
+        for algorithm, command in HASH_ALGORITHMS:
+            if algorithm == 'blake3' and blake3 is None:
+                continue
+            if command in available:
+                return algorithm
+        return 'md5'
+    
     def disconnect(self):
         """断开SSH连接"""
-        if self.scp_client:
-            self.scp_client.close()
+        self.close_sftp_clients()
+        if self.sftp_client:
+            self.sftp_client.close()
         if self.ssh_client:
             self.ssh_client.close()
     
-    def get_remote_file_count(self, remote_path: str) -> int:
-        """获取远程目录文件数量"""
+    def get_sftp_client(self):
+        """获取当前线程的SFTP客户端"""
+        sftp_client = getattr(self._sftp_local, 'client', None)
+        if sftp_client is None:
+            sftp_client = self.ssh_client.open_sftp()
+            self._sftp_local.client = sftp_client
+            with self._sftp_lock:
+                self._sftp_clients.append(sftp_client)
+        return sftp_client
+    
+    def close_sftp_clients(self):
+        """关闭所有下载线程打开的SFTP通道"""
+        with self._sftp_lock:
+            for sftp_client in self._sftp_clients:
+                try:
+                    sftp_client.close()
+                except Exception:
+                    pass
+            self._sftp_clients.clear()
+        # 重置线程局部缓存，下次下载时重新打开通道
+        self._sftp_local = threading.local()
+    
+    def download_file(self, remote_file: str, local_file: str, remote_size: int = 0, expected_hash: str = "",
+                      block_hashes: Optional[List[str]] = None) -> int:
+        """通过SFTP下载单个文件，按传输字节实时更新进度，返回实际传输的字节数"""
+        # 已取得远程分块哈希的大文件只传输变化的数据块
+        if block_hashes and expected_hash:
+            try:
+                return self.download_file_delta(remote_file, local_file, remote_size, expected_hash, block_hashes)
+            except Exception as e:
+                console.print(f"差量传输失败，改为完整下载 {remote_file}: {e}")
+        
+        transferred = [0]
+        
+        def callback(done, total):
+            self.progress_bar.add_transferred(done - transferred[0], remote_file)
+            transferred[0] = done
+        
+        # 先下载到临时文件再替换，不能原地覆盖：旧文件可能与历史版本共享硬链接
+        temp_file = local_file + '.part'
         try:
-            stdin, stdout, stderr = self.ssh_client.exec_command(f'find {remote_path} -type f | wc -l')
-            result = stdout.read().decode('utf-8').strip()
-            return int(result) if result.isdigit() else 0
-        except:
-            return 0
+            self.get_sftp_client().get(remote_file, temp_file, callback=callback)
+            os.replace(temp_file, local_file)
+        except Exception:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+        return transferred[0]
     
-    def get_local_file_count(self, local_path: str) -> int:
-        """获取本地目录文件数量"""
+    def fetch_remote_block_hashes(self, remote_sizes: Dict[str, int], block_size: int) -> Dict[str, List[str]]:
+        """在远程按固定大小分块计算多个文件的哈希（一次SSH调用），返回 {路径: 分块哈希}"""
+        if not remote_sizes:
+            return {}
+        
+        # 每个文件输出各分块的哈希后再输出一个空行作为分隔
+        hash_command = self.incremental_backup.hash_command
+        script = (
+            f'i=0; while [ $i -lt "$2" ]; do '
+            f'dd if="$1" bs={block_size} skip=$i count=1 2>/dev/null | {hash_command}; '
+            f'i=$((i+1)); done; echo'
+        )
+        command = f'xargs -0 -n 2 sh -c {shlex.quote(script)} sh'
+        block_counts = [(file_path, (size + block_size - 1) // block_size) for file_path, size in remote_sizes.items()]
         try:
-            count = 0
-            for root, dirs, files in os.walk(local_path):
-                count += len(files)
-            return count
-        except:
-            return 0
+            stdin, stdout, stderr = self.ssh_client.exec_command(command)
+            
+            # 与 fetch_remote_hashes 相同，在单独线程中写入文件列表
+            def write_paths():
+                try:
+                    stdin.write(''.join(f"{file_path}\0{count}\0" for file_path, count in block_counts))
+                    stdin.channel.shutdown_write()
+                except Exception:
+                    pass
+            
+            writer = threading.Thread(target=write_paths, daemon=True)
+            writer.start()
+            output = stdout.read().decode('utf-8', errors='replace')
+            writer.join()
+        except Exception as e:
+            console.print(f"获取远程分块哈希失败，改为完整下载: {e}")
+            return {}
+        
+        # 按输入顺序对应各文件；分块数量不符的文件不做差量传输
+        block_hashes = {}
+        for (file_path, count), section in zip(block_counts, output.split('\n\n')):
+            hashes = [line.split()[0] for line in section.splitlines() if line.strip()]
+            if len(hashes) == count:
+                block_hashes[file_path] = hashes
+        return block_hashes
     
-    def get_remote_file_size(self, remote_path: str) -> int:
-        """获取远程文件大小"""
+    def download_file_delta(self, remote_file: str, local_file: str, remote_size: int, expected_hash: str,
+                            remote_blocks: List[str]) -> int:
+        """只下载与本地旧文件不同的数据块，拼接后校验整个文件的哈希"""
+        block_size = self.settings.delta_block_size
+        hash_algorithm = self.incremental_backup.hash_algorithm
+        
+        # 与本地文件逐块比较，找出需要下载的块
+        changed_blocks = []
+        buffer = bytearray(block_size)
+        view = memoryview(buffer)
+        with open(local_file, 'rb', buffering=0) as f:
+            for index, remote_block_hash in enumerate(remote_blocks):
+                size = f.readinto(buffer)
+                hasher = new_hasher(hash_algorithm)
+                hasher.update(view[:size])
+                if hasher.hexdigest() != remote_block_hash:
+                    offset = index * block_size
+                    changed_blocks.append((offset, min(block_size, remote_size - offset)))
+        
+        # 在旧文件的副本上修补，不能原地修改：旧文件可能与历史版本共享硬链接
+        temp_file = local_file + '.part'
+        transferred = 0
         try:
-            stdin, stdout, stderr = self.ssh_client.exec_command(f'stat -c%s "{remote_path}"')
-            result = stdout.read().decode('utf-8').strip()
-            return int(result) if result.isdigit() else 0
-        except:
-            return 0
+            copy_file_fast(local_file, temp_file)
+            with open(temp_file, 'r+b') as f:
+                f.truncate(remote_size)
+                if changed_blocks:
+                    with self.get_sftp_client().open(remote_file, 'rb') as remote_f:
+                        # readv 会流水线发送所有读取请求
+                        for (offset, length), data in zip(changed_blocks, remote_f.readv(changed_blocks)):
+                            f.seek(offset)
+                            f.write(data)
+                            transferred += len(data)
+                            self.progress_bar.add_transferred(len(data), remote_file)
+            
+            if self.incremental_backup.calculate_file_hash(temp_file) != expected_hash:
+                raise IOError("拼接后的文件哈希与远程不一致")
+            os.replace(temp_file, local_file)
+        except Exception:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+        return transferred
+    
+    def walk_remote_files(self, remote_path: str) -> Dict[str, Tuple[int, int]]:
+        """遍历远程目录，返回 {路径: (大小, 修改时间)}"""
+        # 优先用一次 find 调用列出所有文件；不支持 -printf 的系统（如 BusyBox）改用SFTP逐目录遍历
+        files = self.find_remote_files(remote_path)
+        if files is None:
+            files = self.walk_remote_files_sftp(remote_path)
+        return files
     
-    def monitor_progress(self, local_path: str):
-        """监控下载进度"""
-        while self.is_downloading:
+    def find_remote_files(self, remote_path: str) -> Optional[Dict[str, Tuple[int, int]]]:
+        """通过一次远程 find 调用获取文件大小和修改时间，失败时返回 None"""
+        command = f"find {shlex.quote(remote_path)} -type f -printf '%s\\t%T@\\t%p\\0'"
+        try:
+            stdin, stdout, stderr = self.ssh_client.exec_command(command)
+            output = stdout.read()
+            exit_status = stdout.channel.recv_exit_status()
+        except Exception as e:
+            self.logger.warning(f"远程 find 执行失败，改用SFTP遍历: {e}")
+            return None
+        
+        files = parse_find_output(output.decode('utf-8', errors='surrogateescape'))
+        
+        # 文件名不是合法UTF-8的文件无法写入索引，也无法通过SFTP传输，跳过并提示，不影响其他文件
+        undecodable = [file_path for file_path in files if not is_valid_utf8(file_path)]
+        for file_path in undecodable:
+            del files[file_path]
+            readable_path = file_path.encode('utf-8', errors='surrogateescape').decode('utf-8', errors='replace')
+            self.logger.warning(f"跳过文件名不是UTF-8编码的文件: {readable_path}")
+        
+        # 部分目录无权限时 find 也会返回非零状态，只有完全没有输出才视为不支持
+        if exit_status != 0 and not files:
+            return None
+        return files
+    
+    def walk_remote_files_sftp(self, remote_path: str) -> Dict[str, Tuple[int, int]]:
+        """通过SFTP遍历远程目录，返回 {路径: (大小, 修改时间)}"""
+        # listdir_attr 在同一个SFTP通道上返回文件属性，无需启动远程shell
+        files = {}
+        pending_dirs = deque([remote_path])
+        while pending_dirs:
+            directory = pending_dirs.popleft()
             try:
-                current_files = self.get_local_file_count(local_path)
-                if self.progress_bar and current_files <= self.total_files:
-                    self.progress_bar.update(current_files)
-                time.sleep(0.5)  # 每0.5秒更新一次
-            except:
-                break
+                entries = self.sftp_client.listdir_attr(directory)
+            except IOError as e:
+                console.print(f"读取远程目录失败 {directory}: {e}")
+                continue
+            for attr in entries:
+                file_path = posixpath.join(directory, attr.filename)
+                if stat.S_ISDIR(attr.st_mode):
+                    pending_dirs.append(file_path)
+                elif stat.S_ISREG(attr.st_mode):
+                    files[file_path] = (attr.st_size, int(attr.st_mtime))
+        return files
+    
+    def get_local_file_count(self, local_path: str) -> int:
+        """获取本地目录文件数量"""
+        try:
+            return sum(1 for _ in iter_local_files(local_path))
+        except:
+            return 0
     
     def download_directory(self, remote_path: str, local_path: str) -> bool:
         """智能备份目录（第一次全量，后续增量）"""
@@ -401,171 +982,209 @@ class SSHBackup:
             
             if is_first_backup:
                 # 第一次备份：全量备份
-                print(f"\n开始全量备份目录: {remote_path}")
-                print("这是第一次备份，将下载所有文件")
-                print("=" * 50)
+                console.print(f"\n开始全量备份目录: {remote_path}")
+                console.print("这是第一次备份，将下载所有文件")
                 
-                # 获取文件总数
-                self.total_files = self.get_remote_file_count(remote_path)
+                # 获取文件总数和总大小
+                self._remote_stats = self.walk_remote_files(remote_path)
+                self.total_files = len(self._remote_stats)
+                total_size = sum(size for size, _ in self._remote_stats.values())
+                console.print(f"需要传输: {self.total_files} 个文件，共 {_format_size(total_size)}")
+                console.print("=" * 50)
                 
+                # 创建进度条，由SFTP下载回调驱动
+                self.progress_bar = None
+                self.copied_files = 0
                 if self.total_files > 0:
-                    # 创建进度条（全量备份不显示文件名，因为SCP是批量传输）
-                    self.progress_bar = ProgressBar(self.total_files, "全量备份", show_file_info=False)
-                    self.is_downloading = True
-                    
-                    # 启动进度监控线程
-                    self.monitor_thread = threading.Thread(target=self.monitor_progress, args=(local_path,))
-                    self.monitor_thread.daemon = True
-                    self.monitor_thread.start()
-                
-                # 使用SCP全量下载，但需要调整目标路径以避免重复目录结构
-                # 获取远程目录的父目录，然后下载到正确的位置
-                remote_parent = os.path.dirname(remote_path)
-                remote_dir_name = os.path.basename(remote_path)
-                 
-                # 创建临时目录用于下载
-                temp_download_dir = os.path.join(os.path.dirname(local_path), f"temp_{remote_dir_name}")
-                
-                # 下载到临时目录
-                self.scp_client.get(remote_path, temp_download_dir, recursive=True)
-                
-                # 将下载的内容移动到正确位置
-                downloaded_content = os.path.join(temp_download_dir, remote_dir_name)
-                if os.path.exists(downloaded_content):
-                    # 如果下载的内容在子目录中，移动到目标位置
-                    if os.path.exists(local_path):
-                        shutil.rmtree(local_path)
-                    shutil.move(downloaded_content, local_path)
-                    # 清理临时目录
-                    shutil.rmtree(temp_download_dir)
-                else:
-                    # 如果下载的内容直接在临时目录中，移动到目标位置
-                    if os.path.exists(local_path):
-                        shutil.rmtree(local_path)
-                    shutil.move(temp_download_dir, local_path)
-                
-                # 停止进度监控
-                self.is_downloading = False
-                if self.monitor_thread:
-                    self.monitor_thread.join(timeout=1)
-                
-                if self.progress_bar:
-                    self.progress_bar.finish()
+                    show_file_info = self.settings.show_current_file
+                    self.progress_bar = ProgressBar(self.total_files, f"[{self.config['name']}] 全量备份",
+                                                    show_file_info=show_file_info, total_size=total_size)
+                    # 与增量备份相同，通过多个SFTP通道并发下载所有文件
+                    self.download_files(remote_path, local_path, list(self._remote_stats))
                 
                 # 第一次备份后，建立哈希索引
                 self.build_hash_index_after_full_backup(remote_path, local_path)
                 
-                print(f"全量备份完成: {remote_path}")
-                print(f"备份文件数量: {self.total_files}")
+                console.print(f"全量备份完成: {remote_path}")
+                console.print(f"备份文件数量: {self.get_local_file_count(local_path)}/{self.total_files}")
                 
             else:
                 # 后续备份：增量备份
-                remote_files = self.incremental_backup.get_remote_file_list(remote_path, self.ssh_client)
+                incremental_backup = self.incremental_backup
+                if incremental_backup.rehash_pending:
+                    # 哈希算法已变化：用新算法重新计算本地备份的哈希。
+                    # 不记录远程文件状态，本次会对所有文件计算远程哈希，与本地副本比较后只下载有变化的文件
+                    self.build_hash_index_after_full_backup(remote_path, local_path, record_stats=False)
+                self._remote_stats = self.walk_remote_files(remote_path)
+                
+                # 大小和修改时间都与索引一致的文件视为未变化，其余文件再批量计算哈希
+                hash_candidates = select_hash_candidates(
+                    self._remote_stats, incremental_backup.file_stats, self.settings.trust_mtime
+                )
+                remote_hashes = incremental_backup.fetch_remote_hashes(hash_candidates, self.ssh_client)
                 
                 # 筛选需要备份的文件
-                files_to_backup = []
-                for file_path in remote_files:
-                    if self.incremental_backup.should_backup_file(file_path, self.ssh_client):
-                        files_to_backup.append(file_path)
+                files_to_backup, unchanged_files = select_changed_files(
+                    hash_candidates, remote_hashes, incremental_backup.hash_index
+                )
+                for file_path in unchanged_files:
+                    # 内容未变，只更新索引中的文件状态
+                    incremental_backup.set_file_hash(file_path, remote_hashes[file_path], *self._remote_stats[file_path])
                 
-                total_files = len(remote_files)
+                total_files = len(self._remote_stats)
                 backup_files = len(files_to_backup)
                 
-                print(f"\n开始增量备份目录: {remote_path}")
-                print(f"总文件数量: {total_files}")
-                print(f"需要备份: {backup_files} 个文件")
-                print(f"跳过文件: {total_files - backup_files} 个文件")
-                print("=" * 50)
+                console.print(f"\n开始增量备份目录: {remote_path}")
+                console.print(f"总文件数量: {total_files}")
+                console.print(f"需要校验: {len(hash_candidates)} 个文件")
+                console.print(f"需要备份: {backup_files} 个文件")
+                console.print(f"跳过文件: {total_files - backup_files} 个文件")
                 
                 if backup_files == 0:
-                    print("所有文件都是最新的，无需备份")
+                    console.print("=" * 50)
+                    console.print("所有文件都是最新的，无需备份")
+                    incremental_backup.save_hash_index()
                     return True
                 
+                transfer_size = sum(self._remote_stats[file_path][0] for file_path in files_to_backup)
+                console.print(f"需要传输: {_format_size(transfer_size)}")
+                console.print("=" * 50)
+                
                 # 创建进度条（根据配置决定是否显示文件信息）
-                show_file_info = self.backup_settings.get('show_current_file', True)
-                self.progress_bar = ProgressBar(backup_files, "增量备份", show_file_info=show_file_info)
+                show_file_info = self.settings.show_current_file
+                self.progress_bar = ProgressBar(backup_files, f"[{self.config['name']}] 增量备份",
+                                                show_file_info=show_file_info, total_size=transfer_size)
                 self.copied_files = 0
                 
-                # 逐个下载需要备份的文件
-                for i, file_path in enumerate(files_to_backup):
-                    try:
-                        # 计算相对路径
-                        rel_path = os.path.relpath(file_path, remote_path)
-                        local_file_path = os.path.join(local_path, rel_path)
-                        
-                        # 确保本地目录存在
-                        os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
-                        
-                        # 获取远程文件大小
-                        file_size = self.get_remote_file_size(file_path)
-                        
-                        # 下载单个文件
-                        self.scp_client.get(file_path, local_file_path)
-                        
-                        self.copied_files += 1
-                        # 更新进度条，包含当前文件名和文件大小
-                        self.progress_bar.update(self.copied_files, file_path, file_size)
-                        
-                    except Exception as e:
-                        print(f"\n文件下载失败 {file_path}: {e}")
-                        # 即使失败也要更新进度条
-                        self.copied_files += 1
-                        self.progress_bar.update(self.copied_files, file_path, 0)
-                        continue
-                
-                if self.progress_bar:
-                    self.progress_bar.finish()
+                transferred_size = self.download_files(remote_path, local_path, files_to_backup, remote_hashes)
                 
-                print(f"增量备份完成: {remote_path}")
-                print(f"实际备份文件: {self.copied_files}/{backup_files}")
+                console.print(f"增量备份完成: {remote_path}")
+                console.print(f"实际备份文件: {self.copied_files}/{backup_files}")
+                console.print(f"实际传输: {_format_size(transferred_size)}/{_format_size(transfer_size)}")
             
             # 保存哈希索引
             self.incremental_backup.save_hash_index()
             return True
             
         except Exception as e:
-            # 停止进度监控
-            self.is_downloading = False
-            if self.monitor_thread:
-                self.monitor_thread.join(timeout=1)
-            
-            print(f"\n备份失败 {remote_path}: {e}")
+            console.print(f"\n备份失败 {remote_path}: {e}")
             return False
     
-    def build_hash_index_after_full_backup(self, remote_path: str, local_path: str):
-        """全量备份后建立哈希索引"""
-        print("正在建立文件索引...")
+    def prepare_delta_transfers(self, download_tasks: List[Tuple[str, str]],
+                                remote_hashes: Dict[str, str]) -> Tuple[Dict[str, str], Dict[str, List[str]]]:
+        """为本地已有旧版本的大文件获取整个文件和各分块的远程哈希，返回 (文件哈希, 分块哈希)"""
+        file_hashes = dict(remote_hashes)
+        delta_min_size = self.settings.delta_min_size
+        if delta_min_size <= 0:
+            return file_hashes, {}
+        
+        candidates = [
+            file_path for file_path, local_file in download_tasks
+            if self._remote_stats[file_path][0] >= delta_min_size and os.path.isfile(local_file)
+        ]
+        if not candidates:
+            return file_hashes, {}
+        
+        # 完整备份等路径没有预先取得远程哈希，没有哈希就无法校验拼接结果，这些文件改为完整下载
+        missing = [file_path for file_path in candidates if not file_hashes.get(file_path)]
+        file_hashes.update(self.incremental_backup.fetch_remote_hashes(missing, self.ssh_client))
+        remote_sizes = {file_path: self._remote_stats[file_path][0] for file_path in candidates if file_hashes.get(file_path)}
+        return file_hashes, self.fetch_remote_block_hashes(remote_sizes, self.settings.delta_block_size)
+    
+    def download_files(self, remote_path: str, local_path: str, file_paths: List[str],
+                       remote_hashes: Optional[Dict[str, str]] = None) -> int:
+        """并发下载文件到本地对应位置，返回实际传输的字节数"""
+        remote_hashes = remote_hashes or {}
+        
+        # 先在主线程计算本地路径并创建目录，下载线程只做网络I/O
+        download_tasks, local_dirs = plan_downloads(remote_path, local_path, file_paths)
+        
+        # 每个目录只创建一次，而不是每个文件调用一次 makedirs
+        for local_dir in local_dirs:
+            os.makedirs(local_dir, exist_ok=True)
+        
+        # 差量传输所需的远程哈希在主线程批量获取，下载线程只使用各自的SFTP通道，
+        # 不再额外打开执行命令的会话，避免超过服务器的 MaxSessions
+        file_hashes, block_hashes = self.prepare_delta_transfers(download_tasks, remote_hashes)
+        
+        transferred_size = 0
+        max_workers = max(1, self.settings.max_concurrent_transfers)
+        try:
+            # 下载线程沿用当前线程的输出前缀
+            with ThreadPoolExecutor(max_workers=max_workers, initializer=console.set_line_prefix,
+                                    initargs=(console.line_prefix(),)) as executor:
+                futures = {
+                    executor.submit(self.download_file, file_path, local_file_path,
+                                    self._remote_stats[file_path][0], file_hashes.get(file_path, ""),
+                                    block_hashes.get(file_path)): file_path
+                    for file_path, local_file_path in download_tasks
+                }
+                for future in as_completed(futures):
+                    file_path = futures[future]
+                    self.copied_files += 1
+                    try:
+                        transferred_size += future.result()
+                        # 下载成功后才更新索引，失败的文件下次会重新备份
+                        if file_path in remote_hashes:
+                            self.incremental_backup.set_file_hash(
+                                file_path, remote_hashes[file_path], *self._remote_stats[file_path]
+                            )
+                    except Exception as e:
+                        console.print(f"文件下载失败 {file_path}: {e}")
+                    # 更新文件进度（传输字节数已由下载回调累计）
+                    self.progress_bar.update(self.copied_files, file_path)
+        finally:
+            # 释放SFTP通道，避免多个备份路径累积超过服务器的会话上限
+            self.close_sftp_clients()
+        
+        if self.progress_bar:
+            self.progress_bar.finish()
+        return transferred_size
+    
+    def build_hash_index_after_full_backup(self, remote_path: str, local_path: str, record_stats: bool = True):
+        """全量备份后建立哈希索引；record_stats 为 False 时不记录远程文件状态"""
+        console.print("正在建立文件索引...")
         
-        # 获取远程文件列表
-        remote_files = self.incremental_backup.get_remote_file_list(remote_path, self.ssh_client)
+        # 文件已全部下载到本地，直接在本地并行计算哈希，无需再读取远程文件
+        file_map = {}
+        for local_file in iter_local_files(local_path):
+            rel_path = os.path.relpath(local_file, local_path).replace(os.sep, '/')
+            file_map[local_file] = posixpath.join(remote_path, rel_path)
         
-        # 为每个文件建立哈希索引
-        for file_path in remote_files:
-            remote_hash = self.incremental_backup.get_remote_file_hash(file_path, self.ssh_client)
-            if remote_hash:
-                self.incremental_backup.hash_index[file_path] = remote_hash
+        indexed = 0
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+            local_hashes = executor.map(self.incremental_backup.calculate_file_hash, file_map)
+            for local_file, file_hash in zip(file_map, local_hashes):
+                if file_hash:
+                    remote_file = file_map[local_file]
+                    size, mtime = self._remote_stats.get(remote_file, (None, None)) if record_stats else (None, None)
+                    self.incremental_backup.set_file_hash(remote_file, file_hash, size, mtime)
+                    indexed += 1
         
-        print(f"已建立 {len(remote_files)} 个文件的索引")
+        console.print(f"已建立 {indexed} 个文件的索引")
 
 
 class BackupManager:
     """备份管理器"""
     
-    def __init__(self, config_file: str = "backup_config.json"):
-        self.config = BackupConfig(config_file)
-        self.logger = BackupLogger().get_logger()
+    def __init__(self, config_file: str = "backup_config.json", config: Optional[BackupConfig] = None,
+                 logger: Optional[logging.Logger] = None):
+        # 调用方已读取过配置时直接复用，避免同一进程重复解析配置文件
+        self.config = config or BackupConfig(config_file)
+        # 日志记录器是进程级的，重新创建会清掉正在使用的处理器，调用方已有时直接复用
+        self.logger = logger or BackupLogger().get_logger()
         
         # 创建备份目录
-        self.backup_dir = Path(self.config.config['backup_settings']['local_backup_dir'])
+        self.backup_dir = Path(self.config.settings.local_backup_dir)
         self.backup_dir.mkdir(exist_ok=True)
     
     def backup_server(self, server_config: Dict) -> bool:
         """备份单个服务器"""
         server_name = server_config['name']
-        print(f"\n开始备份服务器: {server_name}")
-        print(f"服务器地址: {server_config['host']}")
-        print(f"用户名: {server_config['username']}")
-        print("=" * 60)
+        console.print(f"\n开始备份服务器: {server_name}")
+        console.print(f"服务器地址: {server_config['host']}")
+        console.print(f"用户名: {server_config['username']}")
+        console.print("=" * 60)
         
         self.logger.info(f"开始备份服务器: {server_name}")
         
@@ -584,57 +1203,59 @@ class BackupManager:
             # 创建增量备份管理器 - 使用服务器目录而不是根备份目录
             server_dir = self.backup_dir / server_name
             incremental_backup = IncrementalBackup(server_name, server_dir)
-            backup_client = SSHBackup(server_config, self.logger, incremental_backup, self.config.config['backup_settings'])
+            backup_client = SSHBackup(server_config, self.logger, incremental_backup, self.config.settings)
             
             # 建立连接
-            print("正在连接服务器...")
+            console.print("正在连接服务器...")
             if not backup_client.connect():
-                print("连接失败")
+                console.print("连接失败")
+                incremental_backup.close()
                 return False
             
-            print("连接成功")
+            console.print("连接成功")
             
             # 备份每个路径
             for i, remote_path in enumerate(server_config['remote_paths'], 1):
-                print(f"\n备份路径 {i}/{total_paths}: {remote_path}")
+                console.print(f"\n备份路径 {i}/{total_paths}: {remote_path}")
                 
                 # 生成本地路径
                 local_path = server_backup_dir / remote_path.lstrip('/')
                 
                 # 下载目录
                 if backup_client.download_directory(remote_path, str(local_path)):
-                    print(f"路径备份成功: {remote_path}")
+                    console.print(f"路径备份成功: {remote_path}")
                     self.logger.info(f"路径备份成功: {remote_path}")
                 else:
-                    print(f"路径备份失败: {remote_path}")
+                    console.print(f"路径备份失败: {remote_path}")
                     self.logger.error(f"路径备份失败: {remote_path}")
                     success = False
             
             backup_client.disconnect()
-            print("连接已断开")
+            incremental_backup.close()
+            console.print("连接已断开")
             
         except Exception as e:
-            print(f"服务器备份异常: {e}")
+            console.print(f"服务器备份异常: {e}")
             self.logger.error(f"服务器备份异常: {e}")
             success = False
         
         if success:
             # 将当前备份复制到版本目录（用于版本管理）
             try:
-                print("正在创建备份版本...")
+                console.print("正在创建备份版本...")
                 self.copy_backup_to_version(server_backup_dir, version_backup_dir)
-                print(f"备份版本已创建: {version_backup_dir.name}")
+                console.print(f"备份版本已创建: {version_backup_dir.name}")
             except Exception as e:
-                print(f" 创建备份版本失败: {e}")
+                console.print(f" 创建备份版本失败: {e}")
                 self.logger.warning(f"创建备份版本失败: {e}")
             
-            print(f"\n服务器备份完成: {server_name}")
-            print(f"当前备份位置: {server_backup_dir}")
-            print(f"版本备份位置: {version_backup_dir}")
+            console.print(f"\n服务器备份完成: {server_name}")
+            console.print(f"当前备份位置: {server_backup_dir}")
+            console.print(f"版本备份位置: {version_backup_dir}")
             self.logger.info(f"服务器备份完成: {server_name}")
             self.cleanup_old_backups(server_name)
         else:
-            print(f"\n服务器备份失败: {server_name}")
+            console.print(f"\n服务器备份失败: {server_name}")
             self.logger.error(f"服务器备份失败: {server_name}")
             # 删除失败的版本目录
             try:
@@ -645,15 +1266,23 @@ class BackupManager:
         
         return success
     
+    def backup_server_with_prefix(self, server_config: Dict) -> bool:
+        """备份单个服务器，当前线程的输出都加上服务器名前缀"""
+        console.set_line_prefix(f"[{server_config['name']}] ")
+        try:
+            return self.backup_server(server_config)
+        finally:
+            console.set_line_prefix("")
+    
     def copy_backup_to_version(self, source_dir: Path, target_dir: Path):
-        """将当前备份复制到版本目录"""
+        """将当前备份以硬链接快照的方式复制到版本目录"""
         try:
             # 如果目标目录已存在，先删除
             if target_dir.exists():
                 shutil.rmtree(target_dir)
             
-            # 复制整个目录
-            shutil.copytree(source_dir, target_dir)
+            # 版本目录只读不改，未变化的文件直接硬链接，不占用额外空间
+            hardlink_tree(source_dir, target_dir)
             self.logger.info(f"备份版本已创建: {target_dir}")
             
         except Exception as e:
@@ -662,7 +1291,7 @@ class BackupManager:
     
     def cleanup_old_backups(self, server_name: str):
         """清理旧备份，保留指定数量的版本"""
-        max_versions = self.config.config['backup_settings']['max_backup_versions']
+        max_versions = self.config.settings.max_backup_versions
         server_dir = self.backup_dir / server_name
         
         if not server_dir.exists():
@@ -680,45 +1309,66 @@ class BackupManager:
             except Exception as e:
                 self.logger.error(f"删除旧备份版本失败 {old_backup}: {e}")
     
-    def run_backup(self):
-        """执行备份任务"""
-        print("=" * 60)
-        print("自动备份任务开始")
-        print("=" * 60)
+    def run_backup(self, batch: Optional[List[str]] = None):
+        """执行备份任务；batch 为本次合并执行的定时时间点，多个触发只备份一次"""
+        console.print("=" * 60)
+        console.print("自动备份任务开始")
+        console.print("=" * 60)
         
         self.logger.info("开始执行备份任务")
+        if batch and len(batch) > 1:
+            self.logger.info(f"本次备份合并了 {len(batch)} 个定时任务: {', '.join(batch)}")
         start_time = time.time()
         
         success_count = 0
-        total_count = len(self.config.config['servers'])
+        servers = self.config.config['servers']
+        total_count = len(servers)
         
-        print(f"总共需要备份 {total_count} 个服务器")
-        print(f"开始时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        print("=" * 60)
+        # 各服务器使用独立的SSH连接和索引，可以并行备份
+        max_workers = max(1, min(total_count, self.config.settings.max_parallel_servers))
         
-        for i, server_config in enumerate(self.config.config['servers'], 1):
-            print(f"\n进度: {i}/{total_count}")
-            if self.backup_server(server_config):
-                success_count += 1
-                print(f"服务器 {i} 备份成功")
-            else:
-                print(f"服务器 {i} 备份失败")
+        console.print(f"总共需要备份 {total_count} 个服务器")
+        console.print(f"并行备份数: {max_workers}")
+        console.print(f"开始时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        console.print("=" * 60)
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # 并行备份时每行输出前加上服务器名
+            backup_server = self.backup_server if max_workers == 1 else self.backup_server_with_prefix
+            futures = {
+                executor.submit(backup_server, server_config): (i, server_config['name'])
+                for i, server_config in enumerate(servers, 1)
+            }
+            for finished, future in enumerate(as_completed(futures), 1):
+                i, server_name = futures[future]
+                try:
+                    server_success = future.result()
+                except Exception as e:
+                    self.logger.error(f"服务器备份异常 {server_name}: {e}")
+                    server_success = False
+                
+                console.print(f"\n进度: {finished}/{total_count}")
+                if server_success:
+                    success_count += 1
+                    console.print(f"服务器 {i} ({server_name}) 备份成功")
+                else:
+                    console.print(f"服务器 {i} ({server_name}) 备份失败")
         
         end_time = time.time()
         duration = end_time - start_time
         
-        print("\n" + "=" * 60)
-        print("备份任务完成")
-        print("=" * 60)
-        print(f"成功: {success_count}/{total_count}")
-        print(f"失败: {total_count - success_count}/{total_count}")
-        print(f"总耗时: {duration:.2f} 秒")
-        print(f"结束时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        console.print("\n" + "=" * 60)
+        console.print("备份任务完成")
+        console.print("=" * 60)
+        console.print(f"成功: {success_count}/{total_count}")
+        console.print(f"失败: {total_count - success_count}/{total_count}")
+        console.print(f"总耗时: {duration:.2f} 秒")
+        console.print(f"结束时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
         
         if success_count == total_count:
-            print("所有服务器备份成功！")
+            console.print("所有服务器备份成功！")
         else:
-            print("部分服务器备份失败，请检查日志")
+            console.print("部分服务器备份失败，请检查日志")
         
         self.logger.info(f"备份任务完成: {success_count}/{total_count} 成功，耗时 {duration:.2f} 秒")
         
@@ -738,10 +1388,10 @@ def main():
         backup_manager = BackupManager(args.config)
         
         if args.test:
-            print("配置测试模式")
-            print(f"找到 {len(backup_manager.config.config['servers'])} 个服务器配置")
+            console.print("配置测试模式")
+            console.print(f"找到 {len(backup_manager.config.config['servers'])} 个服务器配置")
             for server in backup_manager.config.config['servers']:
-                print(f"- {server['name']} ({server['protocol']}://{server['host']})")
+                console.print(f"- {server['name']} ({server['protocol']}://{server['host']})")
             return
         
         if args.server:
@@ -755,15 +1405,15 @@ def main():
             if server_config:
                 backup_manager.backup_server(server_config)
             else:
-                print(f"未找到服务器: {args.server}")
+                console.print(f"未找到服务器: {args.server}")
         else:
             # 备份所有服务器
             backup_manager.run_backup()
     
     except KeyboardInterrupt:
-        print("\n备份任务被用户中断")
+        console.print("\n备份任务被用户中断")
     except Exception as e:
-        print(f"备份任务执行失败: {e}")
+        console.print(f"备份任务执行失败: {e}")
 
 
 if __name__ == "__main__":
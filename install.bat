@@ -17,7 +17,7 @@ echo Python已安装
 
 echo.
 echo [2/3] 安装依赖包...
-pip install paramiko scp schedule
+pip install "paramiko>=3.3.0" "cryptography>=41.0.0"
 if errorlevel 1 (
     echo 依赖安装失败
     pause
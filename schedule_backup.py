@@ -6,96 +6,397 @@
 
 import os
 import sys
-import time
-import schedule
+import heapq
+import queue
+import atexit
+import signal
+import asyncio
 import logging
-from datetime import datetime
+import logging.handlers
+import threading
+import argparse
+import subprocess
+from datetime import datetime, timedelta, time as dt_time
 
 # 添加当前目录到Python路径
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from backup_script import BackupManager
+from backup_script import BackupConfig, BackupManager, ConsoleStream
+
+# systemd 单元文件的安装位置和名称
+SYSTEMD_UNIT_DIR = "/etc/systemd/system"
+SYSTEMD_UNIT_NAME = "service-backup"
+
+# 相距不超过该分钟数的备份时间点合并为一次备份
+DEFAULT_MERGE_WINDOW_MINUTES = 5
+
+# 收到一次触发后再等待的秒数，期间到达的触发合并为同一次备份
+FIRE_BATCH_SECONDS = 5
+
+
+# 日志处理器是进程级的，只能配置一次，否则多次创建调度器时每条日志会重复输出
+_LOGGING_CONFIGURED = False
+
+
+def _configure_logging():
+    """配置调度器日志（重复调用时不做任何事）"""
+    global _LOGGING_CONFIGURED
+    if _LOGGING_CONFIGURED:
+        return
+    _LOGGING_CONFIGURED = True
+    
+    # 记录日志时只放入队列，由后台线程写文件和控制台，不阻塞事件循环
+    log_queue = queue.Queue(-1)
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    file_handler = logging.FileHandler('schedule.log', encoding='utf-8')
+    file_handler.setFormatter(formatter)
+    # 与备份进度共用同一个控制台输出，日志不会打断进度行
+    console_handler = logging.StreamHandler(ConsoleStream(sys.stderr))
+    console_handler.setFormatter(formatter)
+    
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
+    listener.start()
+    # 退出前写完队列中剩余的日志
+    atexit.register(listener.stop)
+    
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+
+def coalesce_backup_times(times, merge_window_minutes: int) -> tuple:
+    """合并相距过近的备份时间点，每组只保留最早的一个（跨午夜的时间也会合并）"""
+    minutes = sorted({t.hour * 60 + t.minute for t in times})
+    if not minutes:
+        return ()
+    
+    groups = [[minutes[0]]]
+    for minute in minutes[1:]:
+        if minute - groups[-1][-1] <= merge_window_minutes:
+            groups[-1].append(minute)
+        else:
+            groups.append([minute])
+    
+    # 最后一组与第一组隔着午夜相邻时，并入最后一组，如 23:58 和 00:01
+    if len(groups) > 1 and groups[0][0] + 24 * 60 - groups[-1][-1] <= merge_window_minutes:
+        groups[0] = groups.pop() + groups[0]
+    
+    return tuple(sorted(dt_time(group[0] // 60, group[0] % 60) for group in groups))
+
+
+def seconds_until(backup_time: dt_time, now: datetime, min_seconds: float = 0) -> float:
+    """计算从 now 到备份时间点下一次出现（至少 min_seconds 秒之后）还有多少秒"""
+    fire_at = datetime.combine(now.date(), backup_time)
+    if fire_at <= now + timedelta(seconds=min_seconds):
+        fire_at += timedelta(days=1)
+    # 按本地时间换算成时间戳再相减，夏令时切换当天也能在正确的钟点触发
+    return fire_at.timestamp() - now.timestamp()
+
+
+def disable_systemd_timer():
+    """停用之前安装的 systemd 定时器（未安装时不做任何事）"""
+    timer_file = os.path.join(SYSTEMD_UNIT_DIR, f"{SYSTEMD_UNIT_NAME}.timer")
+    if not sys.platform.startswith('linux') or not os.path.exists(timer_file):
+        return
+    try:
+        subprocess.run(['systemctl', 'disable', '--now', f"{SYSTEMD_UNIT_NAME}.timer"], check=True)
+        print("已停用 systemd 定时器")
+    except Exception as e:
+        print(f"停用 systemd 定时器失败: {e}")
 
 
 class ScheduleManager:
     """定时任务管理器"""
     
-    def __init__(self, config_file: str = "backup_config.json"):
+    def __init__(self, config_file: str = "backup_config.json", config: BackupConfig = None,
+                 load_schedule: bool = True):
         self.config_file = config_file
         self.logger = self.setup_logger()
-        self.backup_manager = BackupManager(config_file)
+        self.backup_manager = BackupManager(config_file, config)
+        # 同一时间只允许一个备份任务运行，上一次未结束时新的触发直接跳过
+        self._lock = threading.Lock()
+        # (下次触发的单调时钟截止时间, 备份时间点) 组成的最小堆，堆顶就是最近的任务
+        self._heap = []
+        self._loop = None
+        # 重新加载配置后唤醒调度循环
+        self._wakeup = None
+        # 到期的备份时间点放入队列，由一个工作协程合并后执行
+        self._fires = None
+        
+        # 启动时解析一次定时配置，之后直接使用解析好的时间；
+        # 定时配置是可选的，只执行一次备份时可以没有 schedule 部分，也不需要解析
+        self._enabled, self._times = False, ()
+        schedule_config = self.backup_manager.config.config.get('schedule') or {}
+        if not load_schedule:
+            return
+        try:
+            self._enabled, self._times = self.parse_schedule(schedule_config)
+        except (TypeError, ValueError) as e:
+            self.logger.error("备份时间格式错误: %s", e)
+            self._enabled, self._times = bool(schedule_config.get('enabled', False)), ()
+    
+    def parse_schedule(self, schedule_config: dict) -> tuple:
+        """解析定时配置，返回 (是否启用, 备份时间点)；时间格式错误时抛出 ValueError/TypeError"""
+        enabled = bool(schedule_config.get('enabled', False))
+        if 'backup_times' in schedule_config:
+            backup_times = schedule_config['backup_times']
+        elif 'backup_time' in schedule_config:
+            # 兼容旧的单个备份时间配置
+            backup_times = [schedule_config['backup_time']]
+        else:
+            backup_times = []
+        configured_times = [datetime.strptime(t, '%H:%M').time() for t in backup_times]
+        
+        # 相邻的备份时间合并为一次，避免连续启动的备份争抢磁盘和网络
+        merge_window = schedule_config.get('merge_window_minutes', DEFAULT_MERGE_WINDOW_MINUTES)
+        times = coalesce_backup_times(configured_times, merge_window)
+        if len(times) < len(configured_times):
+            self.logger.info("相距 %s 分钟内的备份时间已合并: %s -> %s",
+                             merge_window, ', '.join(backup_times), self.describe_times(times))
+        return enabled, times
+    
+    def describe_times(self, times: tuple = None) -> str:
+        """格式化备份时间点，用于日志"""
+        return ', '.join(t.strftime('%H:%M') for t in (self._times if times is None else times))
     
     def setup_logger(self):
         """设置日志记录器"""
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler('schedule.log', encoding='utf-8'),
-                logging.StreamHandler()
-            ]
-        )
+        _configure_logging()
         return logging.getLogger(__name__)
     
-    def run_backup_job(self):
-        """执行备份任务"""
-        self.logger.info("定时备份任务开始执行")
+    async def run_backup_job(self, batch: list = None) -> bool:
+        """执行备份任务，返回是否全部成功；batch 为本次合并执行的定时时间点，手动执行时为 None"""
+        if not self._lock.acquire(blocking=False):
+            self.logger.warning("上一次备份任务仍在执行，跳过本次定时备份")
+            return False
+        
+        job_name = "手动备份任务" if batch is None else "定时备份任务"
+        self.logger.info("%s开始执行", job_name)
         try:
-            success = self.backup_manager.run_backup()
+            # 备份是阻塞的网络和磁盘I/O，放到线程池执行，不阻塞事件循环上的调度
+            loop = asyncio.get_running_loop()
+            success = await loop.run_in_executor(None, self.backup_manager.run_backup, batch)
             if success:
-                self.logger.info("定时备份任务执行成功")
+                self.logger.info("%s执行成功", job_name)
             else:
-                self.logger.error("定时备份任务执行失败")
+                self.logger.error("%s执行失败", job_name)
+            return success
         except Exception as e:
-            self.logger.error(f"定时备份任务执行异常: {e}")
+            self.logger.error("%s执行异常: %s", job_name, e)
+            return False
+        finally:
+            self._lock.release()
     
-    def start_scheduler(self):
-        """启动定时调度器"""
-        config = self.backup_manager.config.config
+    def install_systemd(self) -> bool:
+        """生成 systemd 定时器，由系统按时启动备份进程，无需常驻调度器"""
+        if not self._enabled:
+            self.logger.info("定时备份已禁用，不安装 systemd 定时器")
+            disable_systemd_timer()
+            return False
+        
+        if not self._times:
+            self.logger.error("没有有效的备份时间，不安装 systemd 定时器")
+            return False
+        
+        if not sys.platform.startswith('linux'):
+            self.logger.error("systemd 定时器仅支持 Linux，其他系统请直接运行调度器")
+            return False
+        
+        script_path = os.path.abspath(__file__)
+        config_path = os.path.abspath(self.config_file)
+        service_unit = f"""[Unit]
+Description=服务器资源增量备份
+Wants=network-online.target
+After=network-online.target
+
+[Service]
+Type=oneshot
+WorkingDirectory={os.getcwd()}
+ExecStart="{sys.executable}" "{script_path}" --config "{config_path}" --run-once
+"""
+        on_calendar = ''.join(f"OnCalendar=*-*-* {t.strftime('%H:%M')}:00\n" for t in self._times)
+        timer_unit = f"""[Unit]
+Description=服务器资源增量备份定时器
+
+[Timer]
+{on_calendar}Persistent=true
+
+[Install]
+WantedBy=timers.target
+"""
         
-        if not config['schedule']['enabled']:
+        try:
+            for suffix, content in (('service', service_unit), ('timer', timer_unit)):
+                unit_file = os.path.join(SYSTEMD_UNIT_DIR, f"{SYSTEMD_UNIT_NAME}.{suffix}")
+                with open(unit_file, 'w', encoding='utf-8') as f:
+                    f.write(content)
+                self.logger.info("已写入 %s", unit_file)
+            
+            subprocess.run(['systemctl', 'daemon-reload'], check=True)
+            subprocess.run(['systemctl', 'enable', '--now', f"{SYSTEMD_UNIT_NAME}.timer"], check=True)
+        except Exception as e:
+            self.logger.error("安装 systemd 定时器失败: %s", e)
+            return False
+        
+        self.logger.info("systemd 定时器已启用，每天执行 %d 次: %s", len(self._times), self.describe_times())
+        self.logger.info("查看状态: systemctl list-timers %s.timer", SYSTEMD_UNIT_NAME)
+        return True
+    
+    def start_scheduler(self):
+        """启动定时调度器（用于没有 systemd 的系统，如 Windows）"""
+        if not self._enabled:
             self.logger.info("定时备份已禁用")
             return
         
-        # 设置备份时间
-        if 'backup_times' in config['schedule']:
-            # 支持多个备份时间
-            backup_times = config['schedule']['backup_times']
-            for backup_time in backup_times:
-                schedule.every().day.at(backup_time).do(self.run_backup_job)
-            self.logger.info(f"定时备份已设置，每天执行 {len(backup_times)} 次: {', '.join(backup_times)}")
+        if not self._times:
+            self.logger.error("没有有效的备份时间，调度器未启动")
+            return
+        
+        try:
+            asyncio.run(self.serve())
+        except (KeyboardInterrupt, SystemExit):
+            self.logger.info("定时备份已停止")
+    
+    def next_deadline(self, backup_time: dt_time, now: datetime, min_seconds: float = 0) -> float:
+        """把备份时间点的下一次触发换算为事件循环的单调时钟截止时间"""
+        # 只在此处读取一次墙上时钟，之后的等待只依赖单调时钟，不受NTP校时影响
+        return self._loop.time() + seconds_until(backup_time, now, min_seconds)
+    
+    def add_backup_jobs(self):
+        """按当前的备份时间点重建触发时间堆"""
+        now = datetime.now()
+        self._heap = [(self.next_deadline(t, now), t) for t in self._times]
+        heapq.heapify(self._heap)
+        self.logger.info("定时备份已设置，每天执行 %d 次: %s", len(self._times), self.describe_times())
+    
+    def reload(self):
+        """重新读取配置文件并按新的备份时间重新注册任务（收到 SIGHUP 时调用）"""
+        self.logger.info("收到 SIGHUP，重新加载配置")
+        # 新配置全部解析成功后才替换，任何一步失败都保留原配置继续运行
+        try:
+            # 沿用原来的日志记录器，避免清掉正在备份的任务所用的处理器，也不会泄漏日志文件句柄
+            backup_manager = BackupManager(self.config_file, logger=self.backup_manager.logger)
+            enabled, times = self.parse_schedule(backup_manager.config.config.get('schedule') or {})
+        except SystemExit:
+            # 配置文件不存在或不是合法的JSON（BackupConfig 已输出原因）
+            self.logger.error("配置文件加载失败，继续使用原配置")
+            return
+        except Exception as e:
+            self.logger.error("重新加载配置失败，继续使用原配置: %s", e)
+            return
+        
+        # 正在执行的备份仍使用原来的备份管理器，下次触发时才使用新配置
+        self.backup_manager = backup_manager
+        self._enabled, self._times = enabled, times
+        self._heap = []
+        if not self._enabled:
+            self.logger.info("定时备份已禁用，暂停所有定时任务")
+        elif not self._times:
+            self.logger.error("没有有效的备份时间，暂停所有定时任务")
         else:
-            # 兼容旧的单个备份时间配置
-            backup_time = config['schedule']['backup_time']
-            schedule.every().day.at(backup_time).do(self.run_backup_job)
-            self.logger.info(f"定时备份已设置，每天 {backup_time} 执行")
+            self.add_backup_jobs()
+        self._wakeup.set()
+    
+    async def process_fires(self):
+        """从触发队列取出到期的时间点，短时间内到达的多个触发合并为一次备份"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._fires.get()]
+            batch_deadline = loop.time() + FIRE_BATCH_SECONDS
+            while True:
+                remaining = batch_deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._fires.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            
+            await self.run_backup_job([t.strftime('%H:%M') for t in batch])
+            
+            # 备份期间到期的触发不再补做，避免备份耗时过长时连续执行
+            while not self._fires.empty():
+                skipped = self._fires.get_nowait()
+                self.logger.warning("备份期间已到 %s，跳过本次定时备份", skipped.strftime('%H:%M'))
+    
+    async def serve(self):
+        """在事件循环上运行调度器，直到进程被中断"""
+        loop = self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._fires = asyncio.Queue()
+        self.add_backup_jobs()
+        worker = loop.create_task(self.process_fires())
         
-        # 保持程序运行
+        # kill -HUP 重新加载配置，无需重启进程（Windows 没有 SIGHUP）
+        if hasattr(signal, 'SIGHUP'):
+            loop.add_signal_handler(signal.SIGHUP, self.reload)
+        
+        try:
+            await self.dispatch_fires()
+        finally:
+            worker.cancel()
+    
+    async def dispatch_fires(self):
+        """按触发时间堆等待，到期时把时间点放入触发队列"""
+        loop = self._loop
         while True:
-            schedule.run_pending()
-            time.sleep(60)  # 每分钟检查一次
-
-
+            # 休眠到最近的触发时间；没有任务时一直等到重新加载配置
+            timeout = max(0, self._heap[0][0] - loop.time()) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+                # 配置已重新加载，按新的堆重新计算等待时间
+                self._wakeup.clear()
+                continue
+            except asyncio.TimeoutError:
+                pass
+            
+            # 每次触发后按墙上时钟重新计算该时间点的下一次截止时间，校正一天内累积的时钟偏差。
+            # 时间点精确到分钟，从一分钟后起算，墙上时钟略慢时也不会在同一分钟内重复触发
+            _, backup_time = heapq.heappop(self._heap)
+            deadline = self.next_deadline(backup_time, datetime.now(), min_seconds=60)
+            heapq.heappush(self._heap, (deadline, backup_time))
+            
+            # 备份由工作协程执行，调度循环继续等待下一个触发时间
+            self._fires.put_nowait(backup_time)
 
 
 def main():
     """主函数"""
-    import argparse
-    
     parser = argparse.ArgumentParser(description='定时备份调度器')
     parser.add_argument('--config', '-c', default='backup_config.json', help='配置文件路径')
     parser.add_argument('--run-once', action='store_true', help='立即执行一次备份')
+    parser.add_argument('--install-systemd', action='store_true',
+                        help='安装 systemd 定时器（Linux），由系统按时执行备份')
     
     args = parser.parse_args()
     
     if args.run_once:
-        # 立即执行一次备份
-        backup_manager = BackupManager(args.config)
-        backup_manager.run_backup()
+        # 立即执行一次备份，与定时任务走同一个入口并写入同一份日志
+        scheduler = ScheduleManager(args.config, load_schedule=False)
+        # 有服务器备份失败时返回非零退出码，便于 systemctl status 和监控发现；
+        # 不自动重试，由下一次定时触发重新备份，避免反复生成快照挤掉历史版本
+        if not asyncio.run(scheduler.run_backup_job()):
+            sys.exit(1)
+        return
+    
+    # 只读取配置文件判断是否启用定时备份，禁用时不初始化备份管理器和日志
+    config = BackupConfig(args.config)
+    if not (config.config.get('schedule') or {}).get('enabled', False):
+        print("定时备份已禁用")
+        # 重新安装时停用之前安装的定时器，否则 systemd 仍会按原来的时间备份
+        if args.install_systemd:
+            disable_systemd_timer()
+        return
+    
+    # 复用已解析的配置，整个进程只读取一次配置文件
+    if args.install_systemd:
+        scheduler = ScheduleManager(args.config, config)
+        if not scheduler.install_systemd():
+            sys.exit(1)
         return
     
     # 启动定时调度器
-    scheduler = ScheduleManager(args.config)
+    scheduler = ScheduleManager(args.config, config)
     scheduler.start_scheduler()
 
 